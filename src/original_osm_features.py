@@ -38,11 +38,16 @@ for each type of road, we calculated
 
 import os
 import configparser
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import pyogrio
+import shapely
 from shapely.geometry import Point
-from sklearn.neighbors import BallTree
+
+from utils import nearest_haversine, write_csv
 
 
 if 'config.ini' not in os.listdir():
@@ -63,6 +68,9 @@ osm_date = config[project]["osm_date"]
 geom_id = config[project]["geom_id"]
 geom_label = config[project]["geom_label"]
 
+# group_field = "fclass"
+group_field = "group"
+
 
 data_dir = os.path.join(project_dir, 'data')
 
@@ -70,467 +78,344 @@ osm_features_dir = os.path.join(data_dir, 'outputs', dhs_round, 'osm_features')
 os.makedirs(osm_features_dir, exist_ok=True)
 
 
-
 # DHS CLUSTERS
 
-# load buffers/geom created during data prep
 geom_path = os.path.join(data_dir, 'outputs', dhs_round, 'dhs_buffers.geojson')
-buffers_gdf = gpd.read_file(geom_path)
 
-# calculate area of each buffer
-# convert to UTM first, then back to WGS84 (degrees)
-buffers_gdf = buffers_gdf.to_crs(f"EPSG:{country_utm_epsg_code}")
-buffers_gdf["buffer_area"] = buffers_gdf.area
-buffers_gdf['longitude'] = buffers_gdf.centroid.x
-buffers_gdf['latitude'] = buffers_gdf.centroid.y
-buffers_gdf = buffers_gdf.to_crs("EPSG:4326") # WGS84
+
+def load_buffers():
+    """Load the DHS buffers and add area/centroid columns
+
+    Called inside each family pipeline so worker processes load their own
+    copy instead of receiving a large pickled GeoDataFrame.
+    """
+    # load buffers/geom created during data prep
+    buffers_gdf = gpd.read_file(geom_path)
+
+    # calculate area of each buffer
+    # project a temporary copy of the geometry to UTM for the area;
+    # the buffers themselves stay in WGS84 (degrees)
+    buffers_gdf["buffer_area"] = shapely.area(buffers_gdf.geometry.to_crs(f"EPSG:{country_utm_epsg_code}").values)
+    buffers_gdf['longitude'] = buffers_gdf.centroid.x
+    buffers_gdf['latitude'] = buffers_gdf.centroid.y
+    return buffers_gdf
+
+
+def load_crosswalk(osm_type):
+    # load crosswalk for types and assign any not grouped to "other"
+    crosswalk_path = os.path.join(data_dir, f'crosswalks/{osm_type}_type_crosswalk.csv')
+    crosswalk_df = pd.read_csv(crosswalk_path)
+    crosswalk_df.loc[crosswalk_df["group"] == "0", "group"] = "other"
+    return crosswalk_df
 
 
 # ---------------------------------------------------------
-# pois
-# count of each type of pois (100+) in each buffer
+# shared aggregation for all osm feature families
+
+
+def aggregate_features_by_group(feature_gdf, buffers_gdf, group_list, group_field, osm_type):
+    """Aggregate features intersecting each buffer, split by group
+
+    Runs a single spatial index query of the full feature set against the
+    buffer geometries, then splits the resulting (buffer, feature) hit pairs
+    by group with numpy. Produces hit counts per buffer for every group, plus
+    area metrics for buildings and length totals for roads.
+
+    Returns a copy of buffers_gdf with one set of feature columns per group.
+    """
+    # copy of buffers gdf to use for output
+    out_gdf = buffers_gdf.copy(deep=False)
+
+    # query to find features in each buffer
+    # explicit STRtree over the full feature set, built once per family
+    # (avoids rebuilding the spatial index for every group subset, and the
+    # intersects predicate filters out bounding-box-only matches)
+    tree = shapely.STRtree(feature_gdf.geometry.values)
+    bquery = tree.query(buffers_gdf.geometry.values, predicate="intersects")
+    # group of the matched feature for each (buffer, feature) hit pair
+    # categorical codes turn the per-group hit comparisons into integer scans
+    feature_groups = feature_gdf[group_field].astype("category")
+    group_code_lookup = {g: code for code, g in enumerate(feature_groups.cat.categories)}
+    bquery_groups = feature_groups.cat.codes.to_numpy()[bquery[1]]
+
+    if osm_type == 'buildings':
+        bquery_areas = feature_gdf["area"].to_numpy()[bquery[1]]
+    elif osm_type == 'roads':
+        bquery_lengths = feature_gdf["road_length"].to_numpy()[bquery[1]]
+
+    n_buffers = len(buffers_gdf)
+
+    # accumulate the all-groups totals while looping instead of summing the
+    # wide output frame column-wise afterwards
+    all_counts = np.zeros(n_buffers, dtype=np.int64)
+    if osm_type == 'buildings':
+        all_totalarea = np.zeros(n_buffers)
+    elif osm_type == 'roads':
+        all_lengths = np.zeros(n_buffers)
+
+    for group in group_list:
+        print(group)
+        # a group may have no features at all (e.g. filtered out by the
+        # buffer-extent prefilter); fall back to a code past the last
+        # category, which can never match (-1 would match NaN groups)
+        group_hits = bquery_groups == group_code_lookup.get(group, len(feature_groups.cat.categories))
+        group_clusters = bquery[0][group_hits]
+        # count hits per buffer for this group
+        # (bincount sets clusters without relevant features to zero)
+        group_counts = np.bincount(group_clusters, minlength=n_buffers)
+        all_counts += group_counts
+
+        if osm_type == 'buildings':
+            # count / total area / mean area of buildings per buffer
+            group_totalarea = np.bincount(group_clusters, weights=bquery_areas[group_hits], minlength=n_buffers)
+            group_avgarea = np.divide(group_totalarea, group_counts, out=np.zeros(n_buffers), where=group_counts > 0)
+            all_totalarea += group_totalarea
+            out_gdf["{}_buildings_count".format(group)] = group_counts
+            out_gdf["{}_buildings_avgarea".format(group)] = group_avgarea
+            out_gdf["{}_buildings_totalarea".format(group)] = group_totalarea
+            # calculate ratio for building type
+            out_gdf["{}_buildings_ratio".format(group)] = group_totalarea / out_gdf["buffer_area"]
+        elif osm_type == 'roads':
+            # count / total length of roads per buffer
+            group_lengths = np.bincount(group_clusters, weights=bquery_lengths[group_hits], minlength=n_buffers)
+            all_lengths += group_lengths
+            out_gdf[group + "_roads_count"] = group_counts
+            out_gdf[group + "_roads_length"] = group_lengths
+        else:
+            out_gdf[group + f"_{osm_type}_count"] = group_counts
+
+    # combined features across all groups, from the running totals
+    if "all" not in group_list:
+        if osm_type == 'buildings':
+            out_gdf["all_buildings_count"] = all_counts
+            out_gdf["all_buildings_totalarea"] = all_totalarea
+            out_gdf["all_buildings_avgarea"] = np.divide(all_totalarea, all_counts, out=np.zeros(n_buffers), where=all_counts > 0)
+            out_gdf["all_buildings_ratio"] = all_totalarea / out_gdf["buffer_area"]
+        elif osm_type == 'roads':
+            out_gdf["all_roads_count"] = all_counts
+            out_gdf["all_roads_length"] = all_lengths
+        else:
+            out_gdf[f"all_{osm_type}_count"] = all_counts
+
+    return out_gdf
 
-print("Running pois...")
 
-osm_pois_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_pois_free_1.shp')
-osm_pois_a_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_pois_a_free_1.shp')
+# ---------------------------------------------------------
+# pois / traffic / transport
+# count of each type of feature in each buffer
 
-raw_pois_geo = gpd.read_file(osm_pois_shp_path)
-raw_pois_a_geo = gpd.read_file(osm_pois_a_shp_path)
 
-pois_geo_raw = pd.concat([raw_pois_geo, raw_pois_a_geo])
+def run_point_family(osm_type):
+    print(f"Running {osm_type}...")
 
-# load crosswalk for types and assign any not grouped to "other"
-pois_type_crosswalk_path = os.path.join(data_dir, 'crosswalks/pois_type_crosswalk.csv')
-pois_type_crosswalk_df = pd.read_csv(pois_type_crosswalk_path)
-pois_type_crosswalk_df.loc[pois_type_crosswalk_df["group"] == "0", "group"] = "other"
+    osm_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_{osm_type}_free_1.shp')
+    osm_a_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_{osm_type}_a_free_1.shp')
 
-# merge new classification and assign any features without a type to unclassifid
-pois_geo = pois_geo_raw.merge(pois_type_crosswalk_df, left_on="fclass", right_on="type", how="left")
+    # pyogrio reads the full file in one vectorized call (much faster than fiona)
+    # only the columns needed downstream are parsed
+    # concat directly from the reads so neither half is kept alive afterwards
+    geo_raw = pd.concat([
+        pyogrio.read_dataframe(osm_shp_path, columns=["osm_id", "fclass"]),
+        pyogrio.read_dataframe(osm_a_shp_path, columns=["osm_id", "fclass"]),
+    ], ignore_index=True, copy=False)
 
-pois_geo.loc[pois_geo["fclass"].isna(), "group"] = "unclassified"
+    type_crosswalk_df = load_crosswalk(osm_type)
 
-# show breakdown of groups
-print(pois_geo.group.value_counts())
+    # merge new classification and assign any features without a type to unclassifid
+    geo = geo_raw.merge(type_crosswalk_df, left_on="fclass", right_on="type", how="left")
 
-# group_field = "fclass"
-group_field = "group"
+    geo.loc[geo["fclass"].isna(), "group"] = "unclassified"
 
-# split by group
-# pois_group_list = ["all"] + [i for i in set(pois_geo[group_field])]
-pois_group_list = [i for i in set(pois_geo[group_field]) if pd.notnull(i)]
-
-# copy of buffers gdf to use for output
-buffers_gdf_pois = buffers_gdf.copy(deep=True)
-
-for group in pois_group_list:
-    print(group)
-    # subet by group
-    if group == "all":
-        pois_geo_subset = pois_geo.reset_index(inplace=True).copy(deep=True)
-    else:
-        pois_geo_subset = pois_geo.loc[pois_geo[group_field] == group].reset_index().copy(deep=True)
-    # query to find pois in each buffer
-    bquery = pois_geo_subset.sindex.query_bulk(buffers_gdf.geometry)
-    # pois dataframe where each column contains a cluster and one building in it (can have multiple rows per cluster)
-    bquery_df = pd.DataFrame({"cluster": bquery[0], "pois": bquery[1]})
-    # add pois data to spatial query dataframe
-    bquery_full = bquery_df.merge(pois_geo_subset, left_on="pois", right_index=True, how="left")
-    # aggregate spatial query df with pois info, by cluster
-    bquery_agg = bquery_full.groupby("cluster").agg({"pois": "count"})
-    bquery_agg.columns = [group + "_pois_count"]
-    # join cluster back to original buffer_geo dataframe with columns for specific building type queries
-    z1 = buffers_gdf.merge(bquery_agg, left_index=True, right_on="cluster", how="left")
-    # not each cluster will have relevant pois, set those to zero
-    z1.fillna(0, inplace=True)
-    # set index and drop unnecessary columns
-    if z1.index.name != "cluster": z1.set_index("cluster", inplace=True)
-    z2 = z1[group + "_pois_count"]
-    # merge group columns back to main cluster dataframe
-    buffers_gdf_pois = buffers_gdf_pois.merge(z2, left_index=True, right_index=True)
-
-# output final features
-pois_feature_cols = [i for i in buffers_gdf_pois.columns if "_pois_" in i]
-pois_cols = [geom_id] + pois_feature_cols
-pois_features = buffers_gdf_pois[pois_cols].copy(deep=True)
-pois_features['all_pois_count'] = pois_features[pois_feature_cols].sum(axis=1)
-pois_features_path = os.path.join(osm_features_dir, '{}_pois_{}.csv'.format(geom_label, osm_date))
-pois_features.to_csv(pois_features_path, index=False, encoding="utf-8")
+    buffers_gdf = load_buffers()
 
+    # drop features outside the buffer extent; they can never intersect a
+    # buffer and only inflate the spatial index
+    minx, miny, maxx, maxy = buffers_gdf.total_bounds
+    geo = geo.cx[minx:maxx, miny:maxy]
 
-# ---------------------------------------------------------
-# traffic
-# count of each type of traffic item in each buffer
+    # show breakdown of groups
+    print(geo.group.value_counts())
 
-print("Running traffic...")
+    # split by group
+    # (dropna/unique stay in pandas' hash table instead of boxing every
+    # element through a Python set)
+    group_list = geo[group_field].dropna().unique().tolist()
 
-osm_traffic_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_traffic_free_1.shp')
-osm_traffic_a_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_traffic_a_free_1.shp')
+    features_gdf = aggregate_features_by_group(geo, buffers_gdf, group_list, group_field, osm_type)
 
-raw_traffic_geo = gpd.read_file(osm_traffic_shp_path)
-raw_traffic_a_geo = gpd.read_file(osm_traffic_a_shp_path)
+    # output final features
+    feature_cols = [i for i in features_gdf.columns if f"_{osm_type}_" in i]
+    features = features_gdf[[geom_id] + feature_cols].copy(deep=False)
+    features_path = os.path.join(osm_features_dir, '{}_{}_{}.csv'.format(geom_label, osm_type, osm_date))
+    write_csv(features, features_path)
 
-traffic_geo_raw = pd.concat([raw_traffic_geo, raw_traffic_a_geo])
 
-# load crosswalk for types and assign any not grouped to "other"
-traffic_type_crosswalk_path = os.path.join(data_dir, 'crosswalks/traffic_type_crosswalk.csv')
-traffic_type_crosswalk_df = pd.read_csv(traffic_type_crosswalk_path)
-traffic_type_crosswalk_df.loc[traffic_type_crosswalk_df["group"] == "0", "group"] = "other"
+def run_pois():
+    run_point_family('pois')
 
-# merge new classification and assign any features without a type to unclassifid
-traffic_geo = traffic_geo_raw.merge(traffic_type_crosswalk_df, left_on="fclass", right_on="type", how="left")
 
-traffic_geo.loc[traffic_geo["fclass"].isna(), "group"] = "unclassified"
+def run_traffic():
+    run_point_family('traffic')
 
-# show breakdown of groups
-print(traffic_geo.group.value_counts())
 
-# group_field = "fclass"
-group_field = "group"
+def run_transport():
+    run_point_family('transport')
 
-# split by group
-# traffic_group_list = ["all"] + [i for i in set(traffic_geo[group_field])]
-traffic_group_list = [i for i in set(traffic_geo[group_field]) if pd.notnull(i)]
-
-# copy of buffers gdf to use for output
-buffers_gdf_traffic = buffers_gdf.copy(deep=True)
-
-for group in traffic_group_list:
-    print(group)
-    # subet by group
-    if group == "all":
-        traffic_geo_subset = traffic_geo.copy(deep=True)
-    else:
-        traffic_geo_subset = traffic_geo.loc[traffic_geo[group_field] == group].reset_index().copy(deep=True)
-    # query to find traffic in each buffer
-    bquery = traffic_geo_subset.sindex.query_bulk(buffers_gdf.geometry)
-    # traffic dataframe where each column contains a cluster and one building in it (can have multiple rows per cluster)
-    bquery_df = pd.DataFrame({"cluster": bquery[0], "traffic": bquery[1]})
-    # add traffic data to spatial query dataframe
-    bquery_full = bquery_df.merge(traffic_geo_subset, left_on="traffic", right_index=True, how="left")
-    # aggregate spatial query df with traffic info, by cluster
-    bquery_agg = bquery_full.groupby("cluster").agg({"traffic": "count"})
-    bquery_agg.columns = [group + "_traffic_count"]
-    # join cluster back to original buffer_geo dataframe with columns for specific building type queries
-    z1 = buffers_gdf.merge(bquery_agg, left_index=True, right_on="cluster", how="left")
-    # not each cluster will have relevant traffic, set those to zero
-    z1.fillna(0, inplace=True)
-    # set index and drop unnecessary columns
-    if z1.index.name != "cluster": z1.set_index("cluster", inplace=True)
-    z2 = z1[group + "_traffic_count"]
-    # merge group columns back to main cluster dataframe
-    buffers_gdf_traffic = buffers_gdf_traffic.merge(z2, left_index=True, right_index=True)
-
-# output final features
-traffic_feature_cols = [i for i in buffers_gdf_traffic.columns if "_traffic_" in i]
-traffic_cols = [geom_id] + traffic_feature_cols
-traffic_features = buffers_gdf_traffic[traffic_cols].copy(deep=True)
-traffic_features['all_traffic_count'] = traffic_features[traffic_feature_cols].sum(axis=1)
-traffic_features_path = os.path.join(osm_features_dir, '{}_traffic_{}.csv'.format(geom_label, osm_date))
-traffic_features.to_csv(traffic_features_path, index=False, encoding="utf-8")
 
 # ---------------------------------------------------------
-# transport
-# count of each type of transport item in each buffer
+# buildings
+# for each type of building (and all buildings combined)
+# count of buildings in each buffer, average areas of buildings in each buffer, total area of building in each buffer, ratio of building area to total area of buffer
 
-print("Running transport...")
 
-osm_transport_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_transport_free_1.shp')
-osm_transport_a_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_transport_a_free_1.shp')
+def run_buildings():
+    print("Running buildings...")
 
-raw_transport_geo = gpd.read_file(osm_transport_shp_path)
-raw_transport_a_geo = gpd.read_file(osm_transport_a_shp_path)
+    osm_buildings_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_buildings_a_free_1.shp')
+    buildings_geo_raw = pyogrio.read_dataframe(osm_buildings_shp_path, columns=["osm_id", "type"])
 
-transport_geo_raw = pd.concat([raw_transport_geo, raw_transport_a_geo])
+    building_type_crosswalk_df = load_crosswalk('buildings')
 
-# load crosswalk for types and assign any not grouped to "other"
-transport_type_crosswalk_path = os.path.join(data_dir, 'crosswalks/transport_type_crosswalk.csv')
-transport_type_crosswalk_df = pd.read_csv(transport_type_crosswalk_path)
-transport_type_crosswalk_df.loc[transport_type_crosswalk_df["group"] == "0", "group"] = "other"
+    # merge new classification and assign any buildings without a type to unclassifid
+    buildings_geo = buildings_geo_raw.merge(building_type_crosswalk_df, on="type", how="left")
 
-# merge new classification and assign any features without a type to unclassifid
-transport_geo = transport_geo_raw.merge(transport_type_crosswalk_df, left_on="fclass", right_on="type", how="left")
+    buildings_geo.loc[buildings_geo["type"].isna(), "group"] = "unclassified"
 
-transport_geo.loc[transport_geo["fclass"].isna(), "group"] = "unclassified"
+    buffers_gdf = load_buffers()
 
-# show breakdown of groups
-print(transport_geo.group.value_counts())
+    # drop buildings outside the buffer extent; they can never intersect a
+    # buffer and only inflate the spatial index
+    minx, miny, maxx, maxy = buffers_gdf.total_bounds
+    buildings_geo = buildings_geo.cx[minx:maxx, miny:maxy]
 
-# group_field = "fclass"
-group_field = "group"
+    # show breakdown of groups
+    print(buildings_geo.group.value_counts())
 
-# split by group
-# transport_group_list = ["all"] + [i for i in set(transport_geo[group_field])]
-transport_group_list = [i for i in set(transport_geo[group_field]) if pd.notnull(i)]
-
-# copy of buffers gdf to use for output
-buffers_gdf_transport = buffers_gdf.copy(deep=True)
-
-for group in transport_group_list:
-    print(group)
-    # subet by group
-    if group == "all":
-        transport_geo_subset = transport_geo.copy(deep=True)
-    else:
-        transport_geo_subset = transport_geo.loc[transport_geo[group_field] == group].reset_index().copy(deep=True)
-    # query to find transport in each buffer
-    bquery = transport_geo_subset.sindex.query_bulk(buffers_gdf.geometry)
-    # transport dataframe where each column contains a cluster and one building in it (can have multiple rows per cluster)
-    bquery_df = pd.DataFrame({"cluster": bquery[0], "transport": bquery[1]})
-    # add transport data to spatial query dataframe
-    bquery_full = bquery_df.merge(transport_geo_subset, left_on="transport", right_index=True, how="left")
-    # aggregate spatial query df with transport info, by cluster
-    bquery_agg = bquery_full.groupby("cluster").agg({"transport": "count"})
-    bquery_agg.columns = [group + "_transport_count"]
-    # join cluster back to original buffer_geo dataframe with columns for specific building type queries
-    z1 = buffers_gdf.merge(bquery_agg, left_index=True, right_on="cluster", how="left")
-    # not each cluster will have relevant transport, set those to zero
-    z1.fillna(0, inplace=True)
-    # set index and drop unnecessary columns
-    if z1.index.name != "cluster": z1.set_index("cluster", inplace=True)
-    z2 = z1[group + "_transport_count"]
-    # merge group columns back to main cluster dataframe
-    buffers_gdf_transport = buffers_gdf_transport.merge(z2, left_index=True, right_index=True)
-
-# output final features
-transport_feature_cols = [i for i in buffers_gdf_transport.columns if "_transport_" in i]
-transport_cols = [geom_id] + transport_feature_cols
-transport_features = buffers_gdf_transport[transport_cols].copy(deep=True)
-transport_features['all_transport_count'] = transport_features[transport_feature_cols].sum(axis=1)
-transport_features_path = os.path.join(osm_features_dir, '{}_transport_{}.csv'.format(geom_label, osm_date))
-transport_features.to_csv(transport_features_path, index=False, encoding="utf-8")
+    # split by building types
+    # (dropna also takes care of buildings whose group did not crosswalk)
+    buildings_group_list = [i for i in buildings_geo["group"].dropna().unique().tolist() if i not in ["other", "unclassified"]]
 
+    if "all" not in buildings_group_list:
+        buildings_geo = buildings_geo.loc[buildings_geo["group"].isin(buildings_group_list)]
 
-# ---------------------------------------------------------
-# # buildings
-# # for each type of building (and all buildings combined)
-# # count of buildings in each buffer, average areas of buildings in each buffer, total area of building in each buffer, ratio of building area to total area of buffer
-
-print("Running buildings...")
+    # calculate area of each building
+    # project a temporary copy of the geometry to UTM for the area;
+    # the buildings themselves stay in WGS84 (degrees)
+    buildings_geo["area"] = shapely.area(buildings_geo.geometry.to_crs(f"EPSG:{country_utm_epsg_code}").values)
 
-osm_buildings_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_buildings_a_free_1.shp')
-buildings_geo_raw = gpd.read_file(osm_buildings_shp_path)
+    buffers_gdf_buildings = aggregate_features_by_group(buildings_geo, buffers_gdf, buildings_group_list, group_field, 'buildings')
 
-# load crosswalk for building types and assign any not grouped to "other"
-building_type_crosswalk_path = os.path.join(data_dir, 'crosswalks/buildings_type_crosswalk.csv')
-building_type_crosswalk_df = pd.read_csv(building_type_crosswalk_path)
-building_type_crosswalk_df.loc[building_type_crosswalk_df["group"] == "0", "group"] = "other"
+    # output final features
+    buildings_feature_cols = [i for i in buffers_gdf_buildings.columns if "_buildings_" in i]
+    buildings_cols = [geom_id] + buildings_feature_cols
+    buildings_features = buffers_gdf_buildings[buildings_cols].copy(deep=False)
 
-# merge new classification and assign any buildings without a type to unclassifid
-buildings_geo = buildings_geo_raw.merge(building_type_crosswalk_df, on="type", how="left")
+    buildings_features_path = os.path.join(osm_features_dir, f'{geom_label}_buildings_{osm_date}.csv')
+    write_csv(buildings_features, buildings_features_path)
 
-buildings_geo.loc[buildings_geo["type"].isna(), "group"] = "unclassified"
 
-group_field = "group"
+# ---------------------------------------------------------
+# roads
+# for each type of road
+# distance to closest road from cluster centroid, total number of roads in each cluster, and total length of roads in each cluster
 
-# # show breakdown of groups
-print(buildings_geo.group.value_counts())
 
+def run_roads():
+    print("Running roads...")
 
-# split by building types
-# group_list = ["residential"]
-# group_list = ["all"] + [i for i in set(buildings_geo["group"]) if i not in ["other", "unclassified"]]
-buildings_group_list = [i for i in set(buildings_geo["group"]) if i not in ["other", "unclassified"]]
+    osm_roads_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_roads_free_1.shp')
+    roads_raw_geo = pyogrio.read_dataframe(osm_roads_shp_path, columns=["osm_id", "fclass"])
 
-buildings_group_list = [i for i in buildings_group_list if str(i) != 'nan']  #removes nan from building_group_list - Sasan
+    # get each road length
+    # project a temporary copy of the geometry to UTM for the length;
+    # the roads themselves stay in WGS84 (degrees)
+    roads_raw_geo["road_length"] = shapely.length(roads_raw_geo.geometry.to_crs(f"EPSG:{country_utm_epsg_code}").values)
 
-buildings_group_list = buildings_group_list #+ ['all'] #add a section for all buildings into group list
+    roads_type_crosswalk_df = load_crosswalk('roads')
 
+    # merge new classification and assign any features without a type to unclassifid
+    roads_geo = roads_raw_geo.merge(roads_type_crosswalk_df, left_on="fclass", right_on="type", how="left")
 
+    roads_geo.loc[roads_geo["fclass"].isna(), "group"] = "unclassified"
 
-if "all" not in buildings_group_list:
-    buildings_geo = buildings_geo.loc[buildings_geo["group"].isin(buildings_group_list)]
+    # show breakdown of groups
+    print(roads_geo[group_field].value_counts())
 
-# calculate area of each building
-# convert to UTM first, then back to WGS84 (degrees)
-buildings_geo = buildings_geo.to_crs(f"EPSG:{country_utm_epsg_code}")
-buildings_geo["area"] = buildings_geo.area
-buildings_geo = buildings_geo.to_crs("EPSG:4326") # WGS84
+    # split by groups
+    min_road_features = 0 # 1000
+    roads_group_list = [i for i,j in roads_geo[group_field].value_counts().to_dict().items() if j > min_road_features]
 
+    buffers_gdf = load_buffers()
 
-# copy of buffers gdf to use for output
-buffers_gdf_buildings = buffers_gdf.copy(deep=True)
+    #-----------------
+    #find distance to nearest road (based on vertices of roads)
 
-for group in buildings_group_list:
-    print(group)
-    # subet by group
-    if group == "all":
-        buildings_geo_subset = buildings_geo.copy(deep=True)
-    else:
-        buildings_geo_subset = buildings_geo.loc[buildings_geo[group_field] == group].reset_index().copy(deep=True)
-    # query to find buildings in each buffer
-    bquery = buildings_geo_subset.sindex.query_bulk(buffers_gdf.geometry)
-    # building dataframe where each column contains a cluster and one building in it (can have multiple rows per cluster)
-    bquery_df = pd.DataFrame({"cluster": bquery[0], "building": bquery[1]})
-    # add building data to spatial query dataframe
-    bquery_full = bquery_df.merge(buildings_geo_subset, left_on="building", right_index=True, how="left")
-    # aggregate spatial query df with building info, by cluster
-    bquery_agg = bquery_full.groupby("cluster").agg({
-        "area": ["count", "mean", "sum"]
-    })
-    # rename agg df
-    basic_building_cols = ["buildings_count", "buildings_avgarea", "buildings_totalarea"]
-    bquery_agg.columns = ["{}_{}".format(group, i) for i in basic_building_cols]
-    # join cluster back to original buffer_geo dataframe with columns for specific building type queries
-    z1 = buffers_gdf.merge(bquery_agg, left_index=True, right_on="cluster", how="left")
-    # not each cluster will have relevant buildings, set those to zero
-    z1.fillna(0, inplace=True)
-    # calculate ratio for building type
-    z1["{}_buildings_ratio".format(group)] = z1["{}_buildings_totalarea".format(group)] / z1["buffer_area"]
-    # set index and drop unnecessary columns
-    if z1.index.name != "cluster": z1.set_index("cluster", inplace=True)
-    z2 = z1[bquery_agg.columns.to_list() + ["{}_buildings_ratio".format(group)]]
-    # merge group columns back to main cluster dataframe
-    buffers_gdf_buildings = buffers_gdf_buildings.merge(z2, left_index=True, right_index=True)
+    # vectorized (lat, lon) array in radians, as expected by the haversine metric
+    src_points = np.deg2rad(np.column_stack([buffers_gdf.latitude.to_numpy(), buffers_gdf.longitude.to_numpy()]))
 
+    # per-group row indices in one hash-based pass (avoids a full scan per group)
+    roads_group_indices = roads_geo.groupby(group_field, observed=True, sort=False).indices
 
-# output final features
-buildings_feature_cols = [i for i in buffers_gdf_buildings.columns if "_buildings_" in i]
-buildings_cols = [geom_id] + buildings_feature_cols
-buildings_features = buffers_gdf_buildings[buildings_cols].copy(deep=True)
+    # nearest-road results per group, collected as plain numpy arrays and
+    # combined into a dataframe once at the end
+    nearest_data = {}
 
-# buildings_features = pd.read_csv(buildings_features_path)
-# buildings_feature_cols = buildings_features.columns.to_list()
+    for group in roads_group_list:
+        print(group)
+        # subset based on group
+        if group == "all":
+            subset_roads_geo = roads_geo
+        else:
+            subset_roads_geo = roads_geo.iloc[roads_group_indices[group]]
+        # generate array of all road vertices along with the osm id of the road each vertex belongs to
+        line_xy_points, line_xy_idx = shapely.get_coordinates(subset_roads_geo.geometry.values, return_index=True)
+        line_xy_osm_ids = subset_roads_geo["osm_id"].to_numpy()[line_xy_idx]
+        # find nearest road vertex for each cluster centroid
+        # vertices are (lon, lat); haversine expects (lat, lon) in radians
+        closest_dist, closest = nearest_haversine(src_points, np.deg2rad(line_xy_points[:, ::-1]))
+        # haversine distances are in radians; convert to meters
+        closest_dist = closest_dist * 6371000
+        # set final data (osm id of the nearest vertex via one numpy fancy-index)
+        nearest_data["{}_roads_nearest-osmid".format(group)] = line_xy_osm_ids[closest]
+        nearest_data["{}_roads_nearestdist".format(group)] = closest_dist
 
-if 'all' not in buildings_group_list:
-    buildings_features["all_buildings_count"] = buildings_features[[i for i in buildings_feature_cols if i.endswith('_buildings_count')]].sum(axis=1)
-    buildings_features["all_buildings_totalarea"] = buildings_features[[i for i in buildings_feature_cols if i.endswith('_buildings_totalarea')]].sum(axis=1)
-    buildings_features["all_buildings_avgarea"] = buildings_features["all_buildings_totalarea"] / buildings_features["all_buildings_count"]
-    buildings_features["all_buildings_avgarea"].fillna(0, inplace=True)
-    buildings_features = buildings_features.merge(buffers_gdf[[geom_id, 'buffer_area']], on=geom_id, how="left")
-    buildings_features["all_buildings_ratio"] = buildings_features["all_buildings_totalarea"] / buildings_features["buffer_area"]
+    cluster_centroids = pd.DataFrame(nearest_data, index=pd.Index(buffers_gdf[geom_id], name=geom_id))
 
+    # -----------------
+    # calculate number of roads and length of roads intersecting with each buffer
 
-buildings_features_path = os.path.join(osm_features_dir, f'{geom_label}_buildings_{osm_date}.csv')
-buildings_features.to_csv(buildings_features_path, index=False, encoding="utf-8")
+    # drop roads outside the buffer extent before the spatial join; they can
+    # never intersect a buffer and only inflate the spatial index
+    # (the nearest-road search above deliberately keeps the full set, since
+    # the closest road to a centroid may lie outside the buffer extent)
+    minx, miny, maxx, maxy = buffers_gdf.total_bounds
+    roads_bbox_geo = roads_geo.cx[minx:maxx, miny:maxy]
 
+    buffers_gdf_roads = aggregate_features_by_group(roads_bbox_geo, buffers_gdf, roads_group_list, group_field, 'roads')
 
-# ---------------------------------------------------------
-# roads
-# for each type of road
-# distance to closest road from cluster centroid, total number of roads in each cluster, and total length of roads in each cluster
+    # output final features
+    roads_features = buffers_gdf_roads.merge(cluster_centroids, on=geom_id)
+    roads_feature_cols = [i for i in roads_features.columns if "_roads_" in i]
+    roads_cols = [geom_id] + roads_feature_cols
+    roads_features = roads_features[roads_cols].copy(deep=False)
 
-print("Running roads...")
+    roads_features['all_roads_nearestdist'] = roads_features[[i for i in roads_feature_cols if i.endswith("_roads_nearestdist")]].min(axis=1)
+    # roads_features['all_roads_nearest-osmid'] =
 
-osm_roads_shp_path = os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_roads_free_1.shp')
-roads_raw_geo = gpd.read_file(osm_roads_shp_path)
+    roads_features_path = os.path.join(osm_features_dir, '{}_roads_{}.csv'.format(geom_label, osm_date))
+    write_csv(roads_features, roads_features_path)
 
-# get each road length
-# convert to UTM first, then back to WGS84 (degrees)
-roads_raw_geo = roads_raw_geo.to_crs(f"EPSG:{country_utm_epsg_code}")
-roads_raw_geo["road_length"] = roads_raw_geo.geometry.length
-roads_raw_geo = roads_raw_geo.to_crs("EPSG:4326") # WGS84
 
-# load crosswalk for types and assign any not grouped to "other"
-roads_type_crosswalk_path = os.path.join(data_dir, 'crosswalks/roads_type_crosswalk.csv')
-roads_type_crosswalk_df = pd.read_csv(roads_type_crosswalk_path)
-roads_type_crosswalk_df.loc[roads_type_crosswalk_df["group"] == "0", "group"] = "other"
+# ---------------------------------------------------------
 
-# merge new classification and assign any features without a type to unclassifid
-roads_geo = roads_raw_geo.merge(roads_type_crosswalk_df, left_on="fclass", right_on="type", how="left")
 
-roads_geo.loc[roads_geo["fclass"].isna(), "group"] = "unclassified"
+if __name__ == "__main__":
 
-# group_field = "fclass"
-group_field = "group"
+    # the five family pipelines are fully independent (each reads its own
+    # shapefiles and writes its own csv), so run them in parallel
+    pipelines = [run_pois, run_traffic, run_transport, run_buildings, run_roads]
 
-# show breakdown of groups
-print(roads_geo[group_field].value_counts())
-
-
-# split by groups
-min_road_features = 0 # 1000
-roads_group_list = [i for i,j in roads_geo[group_field].value_counts().to_dict().items() if j > min_road_features]
-# roads_group_list = ["all"] + [i for i,j in roads_geo[group_field].value_counts().to_dict().items() if j > 1000]
-# roads_group_list = ["all"] + [i for i in set(roads_geo["fclass"])]
-# roads_group_list = ["all", "primary", "secondary"]
-
-
-#-----------------
-#find distance to nearest road (based on vertices of roads)
-
-
-cluster_centroids = buffers_gdf.copy(deep=True)
-
-src_points = cluster_centroids.apply(lambda x: (x.longitude, x.latitude), axis=1).to_list()
-
-
-for group in roads_group_list:
-    print(group)
-    # subset based on group
-    if group == "all":
-        subset_roads_geo = roads_geo.copy(deep=True)
-    else:
-        subset_roads_geo = roads_geo.loc[roads_geo[group_field] == group].reset_index().copy(deep=True)
-    # generate list of all road vertices and convert to geodataframe
-    line_xy = subset_roads_geo.apply(lambda x: (x.osm_id, x.geometry.xy), axis=1)
-    line_xy_lookup = [j for i in line_xy for j in list(zip([i[0]]*len(i[1][0]), *i[1]))]
-    line_xy_df = pd.DataFrame(line_xy_lookup, columns=["osm_id", "x", "y"])
-    line_xy_points = [(i[1], i[2]) for i in line_xy_lookup]
-    # create ball tree for nearest point lookup
-    #  see https://automating-gis-processes.github.io/site/notebooks/L3/nearest-neighbor-faster.html
-    tree = BallTree(line_xy_points, leaf_size=50, metric='haversine')
-    # query tree
-    distances, indices = tree.query(src_points, k=1)
-    distances = distances.transpose()
-    indices = indices.transpose()
-    # k=1 so output length is array of len=1
-    closest = indices[0]
-    closest_dist = distances[0]
-    # def func to get osm id for closest locations
-    osm_id_lookup = lambda idx: line_xy_df.loc[idx].osm_id
-    # set final data
-    cluster_centroids["{}_roads_nearest-osmid".format(group)] = list(map(osm_id_lookup, closest))
-    cluster_centroids["{}_roads_nearestdist".format(group)] = closest_dist
-
-
-
-cluster_centroids = cluster_centroids[[geom_id] + [i for i in cluster_centroids.columns if "_roads_" in i]]
-cluster_centroids.set_index(geom_id, inplace=True)
-
-
-# # -----------------
-# # calculate number of roads and length of roads intersecting with each buffer
-
-# # copy of buffers gdf to use for output
-buffers_gdf_roads = buffers_gdf.copy(deep=True)
-
-for group in roads_group_list:
-    print(group)
-    if group == "all":
-        subset_roads_geo = roads_geo.copy(deep=True)
-    else:
-        subset_roads_geo = roads_geo.loc[roads_geo[group_field] == group].reset_index().copy(deep=True)
-    # query to find roads in each buffer
-    bquery = subset_roads_geo.sindex.query_bulk(buffers_gdf.geometry)
-    # roads dataframe where each column contains a cluster and one building in it (can have multiple rows per cluster)
-    bquery_df = pd.DataFrame({"cluster": bquery[0], "roads": bquery[1]})
-    # add roads data to spatial query dataframe
-    bquery_full = bquery_df.merge(roads_geo, left_on="roads", right_index=True, how="left")
-    # aggregate spatial query df with roads info, by cluster
-    bquery_agg = bquery_full.groupby("cluster").agg({"road_length": ["count", "sum"]})
-    bquery_agg.columns = [group + "_roads_count", group + "_roads_length"]
-    # join cluster back to original buffer_geo dataframe with columns for specific building type queries
-    z1 = buffers_gdf.merge(bquery_agg, left_index=True, right_on="cluster", how="left")
-    # not each cluster will have relevant roads, set those to zero
-    z1.fillna(0, inplace=True)
-    # set index and drop unnecessary columns
-    if z1.index.name != "cluster": z1.set_index("cluster", inplace=True)
-    z2 = z1[[group + "_roads_count", group + "_roads_length"]]
-    # merge group columns back to main cluster dataframe
-    buffers_gdf_roads = buffers_gdf_roads.merge(z2, left_index=True, right_index=True)
-
-
-# output final features
-roads_features = buffers_gdf_roads.merge(cluster_centroids, on=geom_id)
-roads_feature_cols = [i for i in roads_features.columns if "_roads_" in i]
-roads_cols = [geom_id] + roads_feature_cols
-roads_features = roads_features[roads_cols].copy(deep=True)
-
-roads_features['all_roads_length'] = roads_features[[i for i in roads_feature_cols if i.endswith("_roads_length")]].sum(axis=1)
-roads_features['all_roads_count'] = roads_features[[i for i in roads_feature_cols if i.endswith("_roads_count")]].sum(axis=1)
-roads_features['all_roads_nearestdist'] = roads_features[[i for i in roads_feature_cols if i.endswith("_roads_nearestdist")]].min(axis=1)
-# roads_features['all_roads_nearest-osmid'] =
-
-roads_features_path = os.path.join(osm_features_dir, '{}_roads_{}.csv'.format(geom_label, osm_date))
-roads_features.to_csv(roads_features_path, index=False, encoding="utf-8")
+    with ProcessPoolExecutor(max_workers=len(pipelines)) as executor:
+        futures = [executor.submit(pipeline) for pipeline in pipelines]
+        for future in futures:
+            future.result()
@@ -120,6 +120,8 @@ for dhs_item in dhs_list:
 
         pois_geo = oft.merge_crosswalk(pois_geo_raw, pois_type_crosswalk_df)
 
+        pois_geo = oft.prefilter_extent(pois_geo, buffers_gdf)
+
         pois_group_list = oft.get_groups(pois_geo, group_field)
 
         pois_group_data = oft.point_query.map(pois_group_list, group_field=unmapped(group_field), query_gdf=unmapped(buffers_gdf), osm_gdf=unmapped(pois_geo), osm_type=unmapped("pois"))
@@ -141,6 +143,8 @@ for dhs_item in dhs_list:
 
         traffic_geo = oft.merge_crosswalk(traffic_geo_raw, traffic_type_crosswalk_df)
 
+        traffic_geo = oft.prefilter_extent(traffic_geo, buffers_gdf)
+
         traffic_group_list = oft.get_groups(traffic_geo, group_field)
 
         traffic_group_data = oft.point_query.map(traffic_group_list, group_field=unmapped(group_field), query_gdf=unmapped(buffers_gdf), osm_gdf=unmapped(traffic_geo), osm_type=unmapped("traffic"))
@@ -162,6 +166,8 @@ for dhs_item in dhs_list:
 
         transport_geo = oft.merge_crosswalk(transport_geo_raw, transport_type_crosswalk_df)
 
+        transport_geo = oft.prefilter_extent(transport_geo, buffers_gdf)
+
         transport_group_list = oft.get_groups(transport_geo, group_field)
 
         transport_group_data = oft.point_query.map(transport_group_list, group_field=unmapped(group_field), query_gdf=unmapped(buffers_gdf), osm_gdf=unmapped(transport_geo), osm_type=unmapped("transport"))
@@ -3,14 +3,16 @@ import os
 import datetime
 import sqlite3
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from sklearn.neighbors import BallTree
+import pyogrio
+import shapely
 
 import prefect
 from prefect import task
 
-from utils import SpatiaLite
+from utils import SpatiaLite, nearest_haversine, write_csv
 
 
 @task
@@ -26,13 +28,12 @@ def load_dhs_data(geom_path, geom_id, country_utm_epsg_code):
     buffers_gdf = gpd.read_file(geom_path)
 
     # calculate area of each buffer
-    # convert to UTM first, then back to WGS84 (degrees)
-    buffers_gdf = buffers_gdf.to_crs(epsg=country_utm_epsg_code)
-    buffers_gdf["buffer_area"] = buffers_gdf.area
-    buffers_gdf = buffers_gdf.to_crs("EPSG:4326") # WGS84
+    # project a temporary copy of the geometry to UTM for the area;
+    # the buffers themselves stay in WGS84 (degrees)
+    buffers_gdf["buffer_area"] = shapely.area(buffers_gdf.geometry.to_crs(epsg=country_utm_epsg_code).values)
     buffers_gdf['longitude'] = buffers_gdf.centroid.x
     buffers_gdf['latitude'] = buffers_gdf.centroid.y
-    buffers_gdf['centroid_wkt'] = buffers_gdf.geometry.centroid.apply(lambda x: x.wkt)
+    buffers_gdf['centroid_wkt'] = shapely.to_wkt(buffers_gdf.geometry.centroid.values)
 
     buffers_gdf.set_index(geom_id, inplace=True)
     return buffers_gdf
@@ -56,7 +57,11 @@ def load_osm_shp(type, data_dir, country_name, osm_date):
         os.path.join(data_dir, f'osm/{country_name}-{osm_date}-free.shp/gis_osm_{type}_a_free_1.shp')
     ]
 
-    gdf = pd.concat([gpd.read_file(p) for p in paths if os.path.exists(p)])
+    # pyogrio reads each file in one vectorized call (much faster than fiona)
+    # only the columns needed downstream are parsed
+    gdf = pd.concat(
+        [pyogrio.read_dataframe(p, columns=["osm_id", "fclass"]) for p in paths if os.path.exists(p)],
+        ignore_index=True, copy=False)
     return gdf
 
 
@@ -65,17 +70,28 @@ def merge_crosswalk(osm_raw_gdf, type_crosswalk_df):
     # merge new classification and assign any features without a type to unclassifid
     geo_gdf = osm_raw_gdf.merge(type_crosswalk_df, left_on="fclass", right_on="type", how="left")
     geo_gdf.loc[geo_gdf["fclass"].isna(), "group"] = "other"
+    # categorical group codes make the later per-group comparisons integer scans
+    geo_gdf["group"] = geo_gdf["group"].astype("category")
     return geo_gdf
 
 
+@task(log_stdout=True, max_retries=5, retry_delay=datetime.timedelta(seconds=10))
+def prefilter_extent(osm_gdf, query_gdf):
+    # drop features outside the buffer extent; they can never intersect a
+    # buffer and only inflate the spatial index
+    minx, miny, maxx, maxy = query_gdf.total_bounds
+    return osm_gdf.cx[minx:maxx, miny:maxy]
+
+
 @task(log_stdout=True, max_retries=5, retry_delay=datetime.timedelta(seconds=10))
 def get_groups(osm_gdf, group_field):
     # show breakdown of groups
     print(osm_gdf[group_field].value_counts())
 
     # split by group
-    # group_list = ["all"] + [i for i in set(osm_gdf[group_field])]
-    group_list = [i for i in set(osm_gdf[group_field]) if pd.notnull(i)]
+    # (dropna/unique stay in pandas' hash table instead of boxing every
+    # element through a Python set)
+    group_list = osm_gdf[group_field].dropna().unique().tolist()
     return group_list
 
 
@@ -108,32 +124,22 @@ def point_query(group, group_field, query_gdf, osm_gdf, osm_type):
 
     print(osm_type, ':', group)
     # copy of buffers gdf to use for output
-    query_gdf = query_gdf.copy(deep=True)
+    query_gdf = query_gdf.copy(deep=False)
     query_gdf_index = query_gdf.index.name
     query_gdf.reset_index(inplace=True)
 
     # subet by group
     if group == "all":
-        osm_subset_gdf = osm_gdf.reset_index(inplace=True).copy(deep=True)
+        osm_subset_gdf = osm_gdf.reset_index()
     else:
-        osm_subset_gdf = osm_gdf.loc[osm_gdf[group_field] == group].reset_index().copy(deep=True)
+        osm_subset_gdf = osm_gdf.loc[osm_gdf[group_field] == group].reset_index()
 
     # query to find pois in each buffer
     bquery = osm_subset_gdf.sindex.query_bulk(query_gdf.geometry)
-    # pois dataframe where each column contains a cluster and one building in it (can have multiple rows per cluster)
-    bquery_df = pd.DataFrame({"cluster": bquery[0], osm_type: bquery[1]})
-    # add pois data to spatial query dataframe
-    bquery_full = bquery_df.merge(osm_subset_gdf, left_on=osm_type, right_index=True, how="left")
-    # aggregate spatial query df with pois info, by cluster
-    bquery_agg = bquery_full.groupby("cluster").agg({osm_type: "count"})
-    bquery_agg.columns = [group + f"_{osm_type}_count"]
-    # join cluster back to original buffer_geo dataframe with columns for specific building type queries
-    z1 = query_gdf.merge(bquery_agg, left_index=True, right_index=True, how="left")
-    # not each cluster will have relevant pois, set those to zero
-    z1.fillna(0, inplace=True)
-    # set index and drop unnecessary columns
-    z1.set_index(query_gdf_index, inplace=True)
-    z2 = z1[group + f"_{osm_type}_count"]
+    # bquery is already a pair of aligned (buffer, feature) index arrays, so
+    # count hits per buffer directly; buffers without relevant pois stay zero
+    counts = np.bincount(bquery[0], minlength=len(query_gdf))
+    z2 = pd.Series(counts, index=pd.Index(query_gdf[query_gdf_index], name=query_gdf_index), name=group + f"_{osm_type}_count")
     return z2
 
 
@@ -149,11 +155,11 @@ def merge_features_data(gdf, group_df_list):
 def export_point_features(gdf, geom_id, osm_type, path):
     # output final features
     feature_cols = [i for i in gdf.columns if f"_{osm_type}_" in i]
-    features = gdf[feature_cols].copy(deep=True)
+    features = gdf[feature_cols].copy(deep=False)
     features[f'all_{osm_type}_count'] = features[feature_cols].sum(axis=1)
     features[geom_id] = features.index
     cols = [geom_id] + [i for i in features.columns if i != geom_id]
-    features[cols].to_csv(path, index=False, encoding="utf-8")
+    write_csv(features[cols], path)
 
 
 @task(log_stdout=True, max_retries=5, retry_delay=datetime.timedelta(seconds=10))
@@ -193,12 +199,12 @@ def run_sqlite_query(task, sqlite_access):
 def process_sqlite_results(results_list, query_gdf, country_utm_epsg_code, geom_id, osm_type):
     logger = prefect.context.get("logger")
 
-    query_gdf_output = query_gdf.copy(deep=True)
+    query_gdf_output = query_gdf.copy(deep=False)
 
     for group, row_index, result_df in results_list:
         logger.info(f'{group} {row_index}')
 
-        df = result_df.copy(deep=True)
+        df = result_df.copy(deep=False)
         df['geometry'] = gpd.GeoSeries.from_wkt(df.geometry)
         gdf = gpd.GeoDataFrame(df, geometry='geometry')
         gdf = gdf.set_crs(epsg=4326)
@@ -210,13 +216,14 @@ def process_sqlite_results(results_list, query_gdf, country_utm_epsg_code, geom_
             buffer_area = query_gdf_output.loc[row_index, 'buffer_area']
             query_gdf_output.loc[row_index, f"{group}_buildings_count"] = gdf.shape[0]
 
-            query_gdf_output.loc[row_index, f"{group}_buildings_totalarea"] = gdf.area.sum()
-            query_gdf_output.loc[row_index, f"{group}_buildings_avgarea"] = gdf.area.mean()
-            query_gdf_output.loc[row_index, f"{group}_buildings_ratio"] = gdf.area.sum() / buffer_area
+            areas = shapely.area(gdf.geometry.values)
+            query_gdf_output.loc[row_index, f"{group}_buildings_totalarea"] = areas.sum()
+            query_gdf_output.loc[row_index, f"{group}_buildings_avgarea"] = areas.mean()
+            query_gdf_output.loc[row_index, f"{group}_buildings_ratio"] = areas.sum() / buffer_area
 
         elif osm_type == 'roads':
-            gdf['length'] = gdf.length
-            total_length = gdf.length.sum()
+            gdf['length'] = shapely.length(gdf.geometry.values)
+            total_length = gdf['length'].sum()
 
             query_gdf_output.loc[row_index, f"{group}_roads_length"] = total_length
 
@@ -276,49 +283,42 @@ def create_aggegate_metrics(query_gdf_output, osm_group_lists, osm_type, require
 def export_sqlite(query_gdf_output, features_path, osm_type, geom_id):
     query_gdf_output[geom_id] = query_gdf_output.index
     cols = [geom_id] + [i for i in query_gdf_output.columns if f'_{osm_type}_' in i]
-    features = query_gdf_output[cols].copy(deep=True)
+    features = query_gdf_output[cols].copy(deep=False)
     features.fillna(0, inplace=True)
-    features.to_csv(features_path, index=False, encoding="utf-8")
+    write_csv(features, features_path)
 
 
 @task
 def find_nearest(group_list, group_field, osm_gdf, query_gdf):
 
-    query_gdf = query_gdf.copy(deep=True)
-    src_points = query_gdf.apply(lambda x: (x.longitude, x.latitude), axis=1).to_list()
+    query_gdf = query_gdf.copy(deep=False)
+    # vectorized (lat, lon) array in radians, as expected by the haversine metric
+    src_points = np.deg2rad(np.column_stack([query_gdf.latitude.to_numpy(), query_gdf.longitude.to_numpy()]))
 
     results = []
 
+    # per-group row indices in one hash-based pass (avoids a full scan per group)
+    osm_group_indices = osm_gdf.groupby(group_field, observed=True, sort=False).indices
+
     for group in group_list:
 
         print(f'Roads nearest ({group})')
 
         # subset based on group
         if group != "all":
-            sub_osm_gdf = osm_gdf.loc[osm_gdf[group_field] == group].reset_index().copy(deep=True)
-
-        # generate list of all road vertices and convert to geodataframe
-        line_xy = sub_osm_gdf.apply(lambda x: (x.osm_id, x.geometry.xy), axis=1)
-        line_xy_lookup = [j for i in line_xy for j in list(zip([i[0]]*len(i[1][0]), *i[1]))]
-        line_xy_df = pd.DataFrame(line_xy_lookup, columns=["osm_id", "x", "y"])
-        line_xy_points = [(i[1], i[2]) for i in line_xy_lookup]
-
-        # create ball tree for nearest point lookup
-        #  see https://automating-gis-processes.github.io/site/notebooks/L3/nearest-neighbor-faster.html
-        tree = BallTree(line_xy_points, leaf_size=50, metric='haversine')
-
-        # query tree
-        distances, indices = tree.query(src_points, k=1)
-        distances = distances.transpose()
-        indices = indices.transpose()
-        # k=1 so output length is array of len=1
-        closest = indices[0]
-        closest_dist = distances[0]
-        # def func to get osm id for closest locations
-        osm_id_lookup = lambda idx: line_xy_df.loc[idx].osm_id
-
-        # set final data
-        query_gdf["{}_roads_nearestid".format(group)] = list(map(osm_id_lookup, closest))
+            sub_osm_gdf = osm_gdf.iloc[osm_group_indices[group]]
+
+        # generate array of all road vertices along with the osm id of the road each vertex belongs to
+        line_xy_points, line_xy_idx = shapely.get_coordinates(sub_osm_gdf.geometry.values, return_index=True)
+        line_xy_osm_ids = sub_osm_gdf["osm_id"].to_numpy()[line_xy_idx]
+
+        # find nearest road vertex for each cluster centroid
+        # vertices are (lon, lat); haversine expects (lat, lon) in radians
+        closest_dist, closest = nearest_haversine(src_points, np.deg2rad(line_xy_points[:, ::-1]))
+        # haversine distances are in radians; convert to meters
+        closest_dist = closest_dist * 6371000
+        # set final data (osm id of the nearest vertex via one numpy fancy-index)
+        query_gdf["{}_roads_nearestid".format(group)] = line_xy_osm_ids[closest]
         query_gdf["{}_roads_nearestdist".format(group)] = closest_dist
 
         results.append(query_gdf[["{}_roads_nearestid".format(group), "{}_roads_nearestdist".format(group)]])
@@ -366,8 +366,8 @@ def export_road_features(gdf, geom_id, osm_type, path):
     gdf[geom_id] = gdf.index
     feature_cols = [i for i in gdf.columns if f"_{osm_type}_" in i]
     cols = [geom_id] + feature_cols
-    features = gdf[cols].copy(deep=True)
-    features.to_csv(path, index=False, encoding="utf-8")
+    features = gdf[cols].copy(deep=False)
+    write_csv(features, path)
 
 
 
@@ -105,3 +105,65 @@ def run_flow(flow, executor, prefect_cloud_enabled=False, project_name=None, par
 
     return state
 
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv
+from numba import njit, prange
+from sklearn.neighbors import BallTree
+
+
+def write_csv(df, path):
+    """Write a dataframe to CSV through pyarrow's multithreaded writer
+
+    DataFrame.to_csv serializes row by row through Python; pyarrow's writer
+    is columnar and parallel, which matters on the wide feature tables.
+    """
+    pa.csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), path)
+
+
+# below this many point-to-vertex distance pairs the brute-force numba kernel
+# tends to beat building and querying a BallTree
+BRUTE_FORCE_MAX_PAIRS = 5_000_000
+
+
+@njit(parallel=True, fastmath=True)
+def _nearest_haversine_brute(src_lat, src_lon, v_lat, v_lon):
+    # brute-force nearest vertex for each source point
+    # inputs are in radians; distances returned in radians
+    out_dist = np.empty(src_lat.size)
+    out_idx = np.empty(src_lat.size, np.int64)
+    for i in prange(src_lat.size):
+        best_dist = np.inf
+        best_idx = -1
+        for j in range(v_lat.size):
+            dlat = v_lat[j] - src_lat[i]
+            dlon = v_lon[j] - src_lon[i]
+            a = np.sin(dlat / 2) ** 2 + np.cos(src_lat[i]) * np.cos(v_lat[j]) * np.sin(dlon / 2) ** 2
+            dist = 2 * np.arcsin(np.sqrt(a))
+            if dist < best_dist:
+                best_dist = dist
+                best_idx = j
+        out_dist[i] = best_dist
+        out_idx[i] = best_idx
+    return out_dist, out_idx
+
+
+def nearest_haversine(src_points, vertex_points, leaf_size=40):
+    """Find the nearest vertex to each source point by haversine distance
+
+    Both inputs are (lat, lon) arrays in radians. Small problems are
+    dispatched to a numba-parallel brute-force kernel, where the cost of
+    building a BallTree would dominate; larger ones go through a BallTree
+    built on the vertices and queried in one batch.
+
+    Returns (distances in radians, vertex indices).
+    """
+    if src_points.shape[0] * vertex_points.shape[0] < BRUTE_FORCE_MAX_PAIRS:
+        return _nearest_haversine_brute(
+            np.ascontiguousarray(src_points[:, 0]), np.ascontiguousarray(src_points[:, 1]),
+            np.ascontiguousarray(vertex_points[:, 0]), np.ascontiguousarray(vertex_points[:, 1]))
+
+    tree = BallTree(vertex_points, leaf_size=leaf_size, metric='haversine')
+    distances, indices = tree.query(src_points, k=1)
+    return distances[:, 0], indices[:, 0]